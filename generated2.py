@@ -1,23 +1,101 @@
+import logging
 import os
 import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 import pandas as pd
+import pyarrow as pa
 import streamlit as st
 import plotly.express as px
-from sqlalchemy import create_engine, text
+import connectorx as cx
+import duckdb
+from sqlalchemy import make_url
 from dotenv import load_dotenv
 
+from kernels import group_rolling_mean, group_zscores
+from views import MATERIALIZED_VIEWS
+
 # -----------------------------
 # 1. Setup & DB connection
 # -----------------------------
+st.set_page_config(page_title="Traffic Analysis Dashboard", layout="wide")
+
+# Page styling; emitted once per full run, the refreshing chart fragment
+# below does not re-send it.
+CSS = """
+    <style>
+    /* Sidebar background */
+    .css-1d391kg {  /* sidebar container class may vary by Streamlit version */
+        background-color: #111111;  /* black */
+        color: white;
+    }
+    /* Sidebar text and widgets */
+    .css-1d391kg * {
+        color: white !important;
+    }
+
+    /* Main content background */
+    .css-18e3th9 {  /* main content container class may vary by Streamlit version */
+        background-color: #f5f5f5;  /* light gray */
+    }
+
+    /* Streamlit headers/subheaders */
+    h1, h2, h3, h4, h5, h6 {
+        color: #222222;
+    }
+    </style>
+    """
+
 load_dotenv()
 DATABASE_URL = os.getenv("DATABASE_URL")
-engine = create_engine(DATABASE_URL)
+
+# ConnectorX expects a plain postgresql:// URL without the SQLAlchemy driver
+# suffix. Built on use so the DuckDB backend runs without DATABASE_URL.
+def connectorx_url():
+    return make_url(DATABASE_URL).set(drivername="postgresql").render_as_string(hide_password=False)
+
+# Optional in-process backend: when PARQUET_DIR is set, the queries run in
+# DuckDB over Parquet exports of the two tables instead of Postgres.
+# Export them once from the duckdb CLI inside that directory:
+#   ATTACH '<postgresql:// url>' AS pg (TYPE postgres);
+#   COPY pg.raw_traffic_readings TO 'raw_traffic_readings.parquet';
+#   COPY pg.sensors TO 'sensors.parquet';
+PARQUET_DIR = os.getenv("PARQUET_DIR")
+
+@st.cache_resource
+def get_duckdb():
+    con = duckdb.connect()
+    for table in ("raw_traffic_readings", "sensors"):
+        path = os.path.join(PARQUET_DIR, f"{table}.parquet")
+        con.execute(f"CREATE VIEW {table} AS SELECT * FROM read_parquet('{path}')")
+    # the Parquet snapshot never changes, so plain tables stand in for the views
+    for name, (_, definition) in MATERIALIZED_VIEWS.items():
+        con.execute(f"CREATE TABLE {name} AS {definition}")
+    return con
 
 # -----------------------------
 # 2. Queries definitions
 # -----------------------------
+# Raw readings per sensor in time order. Queries 2, 3 and 6 share this single
+# pull and compute their metrics in pandas, so their SQL is None in QUERIES.
+RAW_READINGS_TTL = 60
+RAW_READINGS_SQL = """
+    SELECT
+        s.sensor_id,
+        s.location_name,
+        r.record_time,
+        r.speed
+    FROM raw_traffic_readings r
+    JOIN sensors s ON s.sensor_id = r.sensor_id
+    ORDER BY s.sensor_id, r.record_time
+"""
+
+# title -> (sql, ttl_seconds). Live panels refresh every minute; whole-table
+# aggregates barely move minute to minute and refresh every 10 minutes.
+# Queries 4 and 5 read the materialized views from views.py, which must be
+# created and kept fresh by running views.py (see there).
 QUERIES = {
-    "1. Identification of traffic peaks and flow intensity": """
+    "1. Identification of traffic peaks and flow intensity": ("""
         WITH hourly_flow AS (
             SELECT 
                 s.location_name,
@@ -27,102 +105,22 @@ QUERIES = {
             JOIN sensors s ON s.sensor_id = r.sensor_id
             GROUP BY s.location_name, hour_slot
         )
-        SELECT *,
-               RANK() OVER (PARTITION BY location_name ORDER BY vehicle_count DESC) AS rank_within_location
+        SELECT location_name,
+               hour_slot,
+               vehicle_count,
+               RANK() OVER (PARTITION BY location_name ORDER BY vehicle_count DESC) = 1 AS is_peak
         FROM hourly_flow
-        ORDER BY location_name, rank_within_location, hour_slot;
-    """,
-    "2. Movement efficiency assessment with slowdown detection": """
-        WITH speed_stats AS (
-            SELECT 
-                s.sensor_id,
-                s.location_name,
-                PERCENTILE_CONT(0.25) WITHIN GROUP (ORDER BY r.speed) AS q1,
-                PERCENTILE_CONT(0.75) WITHIN GROUP (ORDER BY r.speed) AS q3
-            FROM raw_traffic_readings r
-            JOIN sensors s ON s.sensor_id = r.sensor_id
-            GROUP BY s.sensor_id, s.location_name
-        )
-        SELECT 
-            r.sensor_id,
-            s.location_name,
-            r.record_time,
-            r.speed,
-            CASE 
-                WHEN r.speed < q1 - 1.5*(q3 - q1) THEN 'Possible slowdown'
-                WHEN r.speed > q3 + 1.5*(q3 - q1) THEN 'Abnormal high speed'
-                ELSE 'Normal'
-            END AS traffic_status
-        FROM raw_traffic_readings r
-        JOIN sensors s ON s.sensor_id = r.sensor_id
-        JOIN speed_stats q ON q.sensor_id = s.sensor_id
-        ORDER BY s.location_name, r.record_time;
-    """,
-    "3. Dynamic evaluation of traffic conditions": """
-        SELECT
-            s.location_name,
-            r.record_time,
-            AVG(r.speed) OVER (
-                PARTITION BY s.sensor_id
-                ORDER BY r.record_time
-                ROWS BETWEEN 5 PRECEDING AND CURRENT ROW
-            ) AS rolling_avg_speed
-        FROM raw_traffic_readings r
-        JOIN sensors s ON s.sensor_id = r.sensor_id
-        ORDER BY s.location_name, r.record_time;
-    """,
-    "4. Density-speed correlation": """
-            SELECT 
-            s.location_name,
-            COUNT(DISTINCT r.vehicle_id) AS vehicle_count,
-            AVG(r.speed) AS avg_speed
-        FROM raw_traffic_readings r
-        JOIN sensors s ON s.sensor_id = r.sensor_id
-        GROUP BY s.location_name
-        ORDER BY vehicle_count DESC
-    """,
-    "5. Daily traffic trend": """
-        WITH hourly AS (
-            SELECT 
-                EXTRACT(HOUR FROM record_time) AS hour_of_day,
-                AVG(speed) AS avg_speed
-            FROM raw_traffic_readings
-            GROUP BY hour_of_day
-        )
-        SELECT 
-            hour_of_day,
-            avg_speed,
-            LAG(avg_speed) OVER (ORDER BY hour_of_day) AS prev_hour_speed,
-            ROUND(avg_speed - LAG(avg_speed) OVER (ORDER BY hour_of_day), 2) AS delta_speed
-        FROM hourly
-        ORDER BY hour_of_day;
-    """,
-    "6. Irregular patterns and possible incidents": """
-        WITH stats AS (
-            SELECT 
-                s.sensor_id,
-                AVG(r.speed) AS mean_speed,
-                STDDEV(r.speed) AS std_speed
-            FROM raw_traffic_readings r
-            JOIN sensors s ON s.sensor_id = r.sensor_id
-            GROUP BY s.sensor_id
-        )
-        SELECT 
-            r.sensor_id,
-            s.location_name,
-            r.record_time,
-            r.speed,
-            ROUND((r.speed - st.mean_speed) / st.std_speed, 2) AS z_score,
-            CASE 
-                WHEN ABS((r.speed - st.mean_speed) / st.std_speed) > 2.0 THEN 'Irregular'
-                ELSE 'Regular'
-            END AS traffic_status
-        FROM raw_traffic_readings r
-        JOIN sensors s ON s.sensor_id = r.sensor_id
-        JOIN stats st ON st.sensor_id = s.sensor_id
-        ORDER BY ABS((r.speed - st.mean_speed) / st.std_speed) DESC;
-    """,
-    "7. Comparison of speed and time by road type": """
+    """, 60),
+    "2. Movement efficiency assessment with slowdown detection": (None, RAW_READINGS_TTL),
+    "3. Dynamic evaluation of traffic conditions": (None, RAW_READINGS_TTL),
+    "4. Density-speed correlation": ("""
+        SELECT * FROM mv_density ORDER BY vehicle_count DESC
+    """, 600),
+    "5. Daily traffic trend": ("""
+        SELECT hour_of_day, avg_speed FROM mv_hourly_trend ORDER BY hour_of_day
+    """, 600),
+    "6. Irregular patterns and possible incidents": (None, RAW_READINGS_TTL),
+    "7. Comparison of speed and time by road type": ("""
            SELECT 
         s.road_type,
         EXTRACT(HOUR FROM r.record_time)::int AS hour_of_day,
@@ -130,68 +128,106 @@ QUERIES = {
     FROM raw_traffic_readings r
     JOIN sensors s ON s.sensor_id = r.sensor_id
     GROUP BY s.road_type, hour_of_day
-    ORDER BY s.road_type, hour_of_day;
-    """
+    ORDER BY s.road_type, hour_of_day
+    """, 600),
 }
 
 # -----------------------------
 # 3. Streamlit UI
 # -----------------------------
-st.set_page_config(page_title="Traffic Analysis Dashboard", layout="wide")
-st.markdown(
-    """
-    <style>
-    /* Sidebar background */
-    .css-1d391kg {  /* sidebar container class may vary by Streamlit version */
-        background-color: #111111;  /* black */
-        color: white;
-    }
-    /* Sidebar text and widgets */
-    .css-1d391kg * {
-        color: white !important;
-    }
-
-    /* Main content background */
-    .css-18e3th9 {  /* main content container class may vary by Streamlit version */
-        background-color: #f5f5f5;  /* light gray */
-    }
-
-    /* Streamlit headers/subheaders */
-    h1, h2, h3, h4, h5, h6 {
-        color: #222222;
-    }
-    </style>
-    """,
-    unsafe_allow_html=True
-)
+st.markdown(CSS, unsafe_allow_html=True)
 
 st.title("Workshop 01 - Traffic Data Analytics Dashboard")
 
 st.sidebar.title("Dashboard Navigation")
 selected_query = st.sidebar.radio("Select desired analysis", list(QUERIES.keys()))
 st.sidebar.markdown("---")
-refresh_rate = 60
-auto_refresh = st.sidebar.checkbox("Enable auto-refresh every 60 seconds", value=True)
+auto_refresh = st.sidebar.checkbox("Enable auto-refresh", value=True)
+if st.sidebar.button("Clear cache"):
+    st.cache_data.clear()
 
 # -----------------------------
 # 4. Query execution and charts
 # -----------------------------
-def load_data(sql):
-    return pd.read_sql_query(text(sql), engine)
+def arrow_dtype(pa_type):
+    # Keep text columns Arrow-backed (string[pyarrow]) instead of one Python
+    # object per row; numeric and timestamp columns stay NumPy for the
+    # vectorised code and Plotly below.
+    if pa.types.is_string(pa_type) or pa.types.is_large_string(pa_type):
+        return pd.StringDtype("pyarrow")
+    return None
+
+# Results are cached per SQL text and refresh window. A window is ttl seconds
+# long, so each query is re-fetched at most once per its own ttl; the
+# previous window's copy is dropped when a new one starts. The cache ttl only
+# bounds how long an unused entry can linger.
+@st.cache_data(ttl=max(ttl for _, ttl in QUERIES.values()), show_spinner=False)
+def fetch_data(sql: str, window: int) -> pd.DataFrame:
+    if PARQUET_DIR:
+        table = get_duckdb().cursor().sql(sql).to_arrow_table()
+    else:
+        table = cx.read_sql(connectorx_url(), sql, return_type="arrow")
+    # NUMERIC columns (speed, AVG, ROUND) arrive as Arrow decimals
+    for i, field in enumerate(table.schema):
+        if pa.types.is_decimal(field.type):
+            table = table.set_column(i, field.name, table.column(i).cast(pa.float64()))
+    return table.to_pandas(types_mapper=arrow_dtype)
+
+def load_data(sql: str, ttl: int) -> pd.DataFrame:
+    window = int(time.time() // ttl)
+    fetch_data.clear(sql, window - 1)
+    return fetch_data(sql, window)
+
+def load_raw() -> pd.DataFrame:
+    return load_data(RAW_READINGS_SQL, RAW_READINGS_TTL)
+
+def load_query(sql: str | None, ttl: int) -> pd.DataFrame:
+    return load_raw() if sql is None else load_data(sql, ttl)
+
+logger = logging.getLogger(__name__)
+
+
+def log_prefetch_error(future):
+    if future.exception() is not None:
+        logger.error("Prefetch failed", exc_info=future.exception())
+
 
-while True:
-    title = selected_query
-    query = QUERIES[title]
+# Fetch every analysis in the background so switching panels renders from the
+# cache. cache_resource makes this run once per process per refresh window
+# rather than once per session. Panels still read through load_data, so each
+# one keeps refreshing on its own ttl.
+@st.cache_resource(max_entries=1, show_spinner=False)
+def prefetch(window):
+    executor = ThreadPoolExecutor(max_workers=4)
+    for sql, ttl in set(QUERIES.values()):
+        executor.submit(load_query, sql, ttl).add_done_callback(log_prefetch_error)
+    executor.shutdown(wait=False)
+
+
+prefetch(int(time.time() // RAW_READINGS_TTL))
+
+MAX_PLOT_POINTS = 5000
+
+def sample_for_plot(df: pd.DataFrame, anomalies: pd.Series) -> pd.DataFrame:
+    # Keep every anomaly but only a uniform sample of the regular readings,
+    # so scatter plots don't ship every row to the browser.
+    regular = df.loc[~anomalies]
+    regular = regular.sample(n=min(MAX_PLOT_POINTS, len(regular)), random_state=0)
+    return pd.concat([df.loc[anomalies], regular])
+
+# The fragment re-runs on its own every ttl seconds of the selected query, so
+# only the data and chart section is rebuilt instead of the whole script.
+query, ttl = QUERIES[selected_query]
+
+@st.fragment(run_every=ttl if auto_refresh else None)
+def render_chart(title, query, ttl):
     st.subheader(title)
-    df = load_data(query)
+    df = load_query(query, ttl)
 
     if df.empty:
         st.warning("No data returned.")
     else:
         if "flow" in title.lower():
-            df["hour_slot"] = pd.to_datetime(df["hour_slot"])
-            df = df.sort_values(by=["location_name", "hour_slot"])
-            df["hour_of_day"] = df["hour_slot"].dt.hour
             all_locations = df["location_name"].unique()
             selected_locations = st.multiselect(
                 "Select locations to display:",
@@ -199,7 +235,7 @@ while True:
                 default=all_locations,
                 key=f"loc_select_{title}"
             )
-            filtered_df = df[df["location_name"].isin(selected_locations)]
+            filtered_df = df[df["location_name"].isin(selected_locations)].sort_values(["location_name", "hour_slot"])
             fig = px.line(
                 filtered_df,
                 x="hour_slot",
@@ -208,7 +244,7 @@ while True:
                 title="Hourly Vehicle Flow per Location",
                 markers=True
             )
-            peaks = filtered_df[filtered_df["rank_within_location"] == 1]
+            peaks = filtered_df[filtered_df["is_peak"]]
             fig.add_scatter(
                 x=peaks["hour_slot"],
                 y=peaks["vehicle_count"],
@@ -229,10 +265,20 @@ while True:
                     itemdoubleclick="toggleothers")
             )
 
-            st.plotly_chart(fig, use_container_width=True)
+            st.plotly_chart(fig, use_container_width=True, theme=None, key=f"plot_{title}")
 
         elif "slowdown" in title.lower():
-            fig = px.scatter(df, x="record_time", y="speed", color="traffic_status", title="Speed Outlier Detection")
+            quartiles = df.groupby("sensor_id")["speed"].quantile([0.25, 0.75]).unstack()
+            quartiles.columns = ["q1", "q3"]
+            df = df.join(quartiles, on="sensor_id")
+            iqr = df["q3"] - df["q1"]
+            df["traffic_status"] = np.select(
+                [df["speed"] < df["q1"] - 1.5*iqr, df["speed"] > df["q3"] + 1.5*iqr],
+                ["Possible slowdown", "Abnormal high speed"],
+                default="Normal"
+            )
+            df_plot = sample_for_plot(df, df["traffic_status"] != "Normal")
+            fig = px.scatter(df_plot, x="record_time", y="speed", color="traffic_status", title="Speed Outlier Detection")
             fig.update_layout(
                 xaxis_title="Hour of Day",
                 yaxis_title="Speed",
@@ -242,15 +288,22 @@ while True:
                     itemclick="toggle",
                     itemdoubleclick="toggleothers")
             )
-            st.plotly_chart(fig, use_container_width=True)
-            summary = df.groupby("location_name")["traffic_status"].value_counts().unstack(fill_value=0)
-            desired_order = ["Possible slowdown", "Abnormal high speed", "Normal"]
-            summary = summary.reindex(columns=desired_order, fill_value=0) # ensure consistent order
-            summary = summary.reset_index().rename(columns={"location_name": "Location Name"})
+            st.plotly_chart(fig, use_container_width=True, theme=None, key=f"plot_{title}")
+            summary = (
+                pd.crosstab(df["location_name"], df["traffic_status"])
+                .reindex(columns=["Possible slowdown", "Abnormal high speed", "Normal"], fill_value=0) # ensure consistent order
+                .rename_axis("Location Name")
+                .reset_index()
+            )
             st.subheader("Traffic Status Summary by Location")
             st.dataframe(summary)
 
         elif "dynamic" in title.lower():
+            # current reading plus the 5 preceding ones, per sensor
+            codes, _ = pd.factorize(df["sensor_id"])
+            df["rolling_avg_speed"] = group_rolling_mean(codes, df["speed"].to_numpy(np.float64), 6)
+            # the rolling average needs sensor order; the chart joins points per location in time order
+            df = df.sort_values(["location_name", "record_time"])
             fig = px.line(df, x="record_time", y="rolling_avg_speed", color="location_name", title="Rolling Average Speed")
             fig.update_layout(
                 xaxis_title="Hour of Day",
@@ -261,7 +314,7 @@ while True:
                     itemclick="toggle",
                     itemdoubleclick="toggleothers")
             )
-            st.plotly_chart(fig, use_container_width=True)
+            st.plotly_chart(fig, use_container_width=True, theme=None, key=f"plot_{title}")
 
         elif "density" in title.lower():
             corr = df["vehicle_count"].corr(df["avg_speed"])
@@ -279,13 +332,21 @@ while True:
 
         elif "trend" in title.lower():
             fig = px.line(df, x="hour_of_day", y="avg_speed", title="Average Speed Throughout the Day")
-            st.plotly_chart(fig, use_container_width=True)
+            st.plotly_chart(fig, use_container_width=True, theme=None, key=f"plot_{title}")
 
         elif "irregular" in title.lower():
-            df["record_time"] = pd.to_datetime(df["record_time"])
-            df["abs_z"] = df["z_score"].abs()
+            codes, sensors = pd.factorize(df["sensor_id"])
+            z = pd.Series(group_zscores(codes, df["speed"].to_numpy(np.float64), len(sensors)), index=df.index)
+            df["traffic_status"] = np.where(z.abs() > 2.0, "Irregular", "Regular")
+            # float32 is plenty for the plotted speed and colour columns and keeps
+            # their typed arrays small; z_score stays float64 because hover_data
+            # serializes it as text, where float32 prints long decimals
+            df["z_score"] = z.round(2)
+            df["abs_z"] = z.abs().round(2).astype("float32")
+            df["speed"] = df["speed"].astype("float32")
+            df_plot = sample_for_plot(df, df["traffic_status"] == "Irregular")
             fig = px.scatter(
-                df,
+                df_plot,
                 x="record_time",
                 y="speed",
                 color="abs_z",  # severity
@@ -296,13 +357,6 @@ while True:
                 hover_data=["z_score", "traffic_status"],
                 height=1000
             )
-            for loc in df["location_name"].unique():
-                subset = df[df["location_name"] == loc]
-                mean = subset["speed"].mean()
-                std = subset["speed"].std()
-                upper = mean + 1.7*std
-                lower = mean - 1.7*std
-
             fig.update_layout(
                 xaxis_title="Hour of Day",
                 yaxis_title="Speed",
@@ -310,10 +364,10 @@ while True:
                 showlegend=False,
                 hovermode="x unified"
             )
-            st.plotly_chart(fig, use_container_width=True)
+            st.plotly_chart(fig, use_container_width=True, theme=None, key=f"plot_{title}")
 
         elif "road type" in title.lower():
-            df["hour_of_day"] = df["hour_of_day"].astype(int)
+            df["hour_of_day"] = df["hour_of_day"].astype("int8")
             fig = px.line(
                 df,
                 x="hour_of_day",
@@ -328,9 +382,7 @@ while True:
                 legend_title="Road Type",
                 hovermode="x unified"
             )
-            st.plotly_chart(fig, use_container_width=True)
+            st.plotly_chart(fig, use_container_width=True, theme=None, key=f"plot_{title}")
+
 
-    if not auto_refresh:
-        break
-    time.sleep(refresh_rate)
-    st.rerun()
+render_chart(selected_query, query, ttl)
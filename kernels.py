@@ -0,0 +1,57 @@
+import numpy as np
+from numba import njit
+
+# Per-sensor kernels over the raw readings. `codes` are the group codes from
+# pd.factorize(df["sensor_id"]); rows must be ordered by sensor and time, as
+# RAW_READINGS_SQL returns them. Like pandas (and SQL AVG/STDDEV), NaN values
+# are skipped; error_model="numpy" makes a zero std give NaN instead of
+# raising ZeroDivisionError.
+
+
+@njit(cache=True, error_model="numpy")
+def group_zscores(codes, values, n_groups):
+    # Two passes for mean and std (ddof=1, matching pandas and Postgres
+    # STDDEV) and one for the z-scores, without any per-group Python work.
+    counts = np.zeros(n_groups)
+    sums = np.zeros(n_groups)
+    for i in range(values.size):
+        if not np.isnan(values[i]):
+            counts[codes[i]] += 1
+            sums[codes[i]] += values[i]
+    mean = sums / counts
+
+    sq_dev = np.zeros(n_groups)
+    for i in range(values.size):
+        if not np.isnan(values[i]):
+            d = values[i] - mean[codes[i]]
+            sq_dev[codes[i]] += d * d
+    std = np.sqrt(sq_dev / (counts - 1))
+
+    out = np.empty_like(values)
+    for i in range(values.size):
+        out[i] = (values[i] - mean[codes[i]]) / std[codes[i]]
+    return out
+
+
+@njit(cache=True, error_model="numpy")
+def group_rolling_mean(codes, values, window):
+    # Mean of the non-NaN values among the current row and up to window - 1
+    # preceding ones within the same group, i.e.
+    # rolling(window, min_periods=1).mean() per group.
+    out = np.empty_like(values)
+    start = 0
+    total = 0.0
+    n_obs = 0
+    for i in range(values.size):
+        if i > 0 and codes[i] != codes[i - 1]:
+            start = i
+            total = 0.0
+            n_obs = 0
+        if not np.isnan(values[i]):
+            total += values[i]
+            n_obs += 1
+        if i - start >= window and not np.isnan(values[i - window]):
+            total -= values[i - window]
+            n_obs -= 1
+        out[i] = total / n_obs if n_obs > 0 else np.nan
+    return out
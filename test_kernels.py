@@ -0,0 +1,35 @@
+import numpy as np
+import pandas as pd
+
+from kernels import group_rolling_mean, group_zscores
+
+# Constant speeds (std 0), a single reading, NaN gaps, an all-NaN sensor and
+# a sensor longer than the rolling window.
+READINGS = pd.DataFrame({
+    "sensor_id": [4, 4, 4, 9, 2, 2, 2, 2, 2, 2, 2, 2, 2, 7, 7],
+    "speed": [50.0, 50.0, 50.0, 31.0, 1.0, np.nan, 3.0, 4.0, 5.0, 6.0, 7.0, np.nan, 9.0, np.nan, np.nan],
+})
+
+
+def test_group_zscores_matches_pandas():
+    codes, sensors = pd.factorize(READINGS["sensor_id"])
+    speed_by_sensor = READINGS.groupby("sensor_id")["speed"]
+    expected = (READINGS["speed"] - speed_by_sensor.transform("mean")) / speed_by_sensor.transform("std")
+
+    result = group_zscores(codes, READINGS["speed"].to_numpy(np.float64), len(sensors))
+
+    np.testing.assert_allclose(result, expected.to_numpy(), equal_nan=True)
+
+
+def test_group_rolling_mean_matches_pandas():
+    codes, _ = pd.factorize(READINGS["sensor_id"])
+    expected = (
+        READINGS.groupby("sensor_id", sort=False)["speed"]
+        .rolling(6, min_periods=1)
+        .mean()
+        .reset_index(level=0, drop=True)
+    )
+
+    result = group_rolling_mean(codes, READINGS["speed"].to_numpy(np.float64), 6)
+
+    np.testing.assert_allclose(result, expected.to_numpy(), equal_nan=True)